@@ -0,0 +1,38 @@
+import json
+import math
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; the standard library json module is the fallback
+    orjson = None
+
+def _plain(obj):
+    """
+    Converts numpy values to python ones and non-finite floats to None,
+    which is what orjson writes, so both encoders give the same output.
+    """
+    if isinstance(obj, dict):
+        return {k: _plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_plain(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return _plain(obj.tolist())
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and not math.isfinite(obj):
+        return None
+    return obj
+
+def dumps(obj):
+    if orjson is None:
+        return json.dumps(_plain(obj), separators=(',', ':'), allow_nan=False)
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY |
+            orjson.OPT_NON_STR_KEYS).decode()
+
+def loads(json_string):
+    if orjson is None:
+        return json.loads(json_string)
+    return orjson.loads(json_string)
@@ -1,8 +1,46 @@
-import json
-import copy
 import math
 
+import numpy as np
+
+try:
+    from . import _json
+except ImportError:
+    # run as a script, e.g. python distribution_math/gaus_1D.py
+    import _json
+
+def _welford_update(n, mean, M2, points):
+    """
+    Welford's online update of the count, mean and sum of squared deviations
+    over an array of points.
+    """
+    for x in points:
+        n += 1
+        delta = x - mean
+        mean += delta/n
+        M2 += delta*(x - mean)
+    return n, mean, M2
+
+_welford_kernel = None
+
+def _get_welford_kernel():
+    """
+    Returns _welford_update compiled with numba, or as plain python if numba
+    is not installed. numba is slow to import, so this is deferred until the
+    first batch update.
+    """
+    global _welford_kernel
+    if _welford_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _welford_kernel = _welford_update
+        else:
+            _welford_kernel = njit(cache=True, fastmath=True)(_welford_update)
+    return _welford_kernel
+
 class Gaus1D(object):
+    __slots__ = ('dist_type', 'mean', 'variance', 'n', 'M2')
+
     def __init__(self, mean, variance, prior_strength=2):
         """
         Initialize a 1D gaussian. Assume it was generated from one data point
@@ -26,7 +64,13 @@ class Gaus1D(object):
         self.M2 = self.variance * (self.n-1)
 
     def to_json_string(self):
-        return json.dumps(self.__dict__)
+        return _json.dumps({
+            'dist_type': self.dist_type,
+            'mean': self.mean,
+            'variance': self.variance,
+            'n': self.n,
+            'M2': self.M2,
+        })
 
     def update(self, point, debug = False):
         """
@@ -46,11 +90,34 @@ class Gaus1D(object):
                 'variance, which is not allowed.' \
                 .format(self.dist_type)
 
+    def update_batch(self, points):
+        """
+        Refit gaussian object to an array of new points. Equivalent to calling
+        update on each point in turn.
+        """
+        points = np.asarray(points, dtype=np.float64).ravel()
+        if points.size == 0:
+            return
+        self.n, self.mean, self.M2 = _get_welford_kernel()(
+                self.n, float(self.mean), float(self.M2), points)
+        self.variance = self.M2/(self.n-1)
+        if self.variance==0:
+            assert self.variance != 0, '{} is updating itself to have zero' \
+                'variance, which is not allowed.' \
+                .format(self.dist_type)
+
     def copy(self):
-        return copy.deepcopy(self)
+        g = self.__class__.__new__(self.__class__)
+        g.dist_type = self.dist_type
+        g.mean = self.mean
+        g.variance = self.variance
+        g.n = self.n
+        g.M2 = self.M2
+        return g
 
     def __repr__(self):
-        return json.dumps(self.__dict__,indent=2)
+        return '{}(mean={:.6g}, var={:.6g}, n={})'.format(
+                self.dist_type, self.mean, self.variance, self.n)
 
     def __mul__(self,g2):
         if not isinstance(g2, Gaus1D):
@@ -82,6 +149,36 @@ class Gaus1D(object):
     def __rmul__(self,g2):
         return self.__mul__(g2)
 
+    @classmethod
+    def product_many(cls, means, variances):
+        """
+        Product of many gaussians, given as arrays of their means and
+        variances. Equivalent to chaining __mul__ over all of them.
+        """
+        means = np.asarray(means, dtype=np.float64)
+        variances = np.asarray(variances, dtype=np.float64)
+        if means.shape != variances.shape or means.size == 0:
+            raise ValueError("{}.{} needs non-empty means and variances of " \
+                    "the same shape. Given shapes: {} and {}".format(
+                        cls.__name__,
+                        cls.product_many.__name__,
+                        means.shape,
+                        variances.shape
+                        )
+                    )
+        if np.any(variances == 0):
+            raise ValueError("{} objects cannot have zero variance.".format(
+                        cls.__name__)
+                    )
+
+        precision = 1./variances
+        variance_3 = 1./precision.sum()
+        mean_3 = variance_3 * (precision * means).sum()
+        return_gaus = cls(float(mean_3), float(variance_3))
+        return_gaus.M2 = None
+        return_gaus.n = None
+        return return_gaus
+
     def KL_Div(self,g2):
         """
         Calculates KL divergence between self and another gaussian
@@ -98,27 +195,56 @@ class Gaus1D(object):
                     type(g2)
                     )
                 )
-        sig_1 = self.variance**0.5
-        sig_2 = g2.variance**0.5
-        mu_1 = self.mean
-        mu_2 = g2.mean
+        # log(sig_2/sig_1) == 0.5*log(var_2/var_1), so no square roots needed
+        var_1 = self.variance
+        var_2 = g2.variance
+        delta = self.mean - g2.mean
 
-        KL = math.log(sig_2/sig_1) + (sig_1**2+(mu_1-mu_2)**2)/(2*sig_2**2) - 0.5
+        KL = 0.5 * (math.log(var_2/var_1) + (var_1 + delta*delta)/var_2 - 1.)
         return KL
 
+    @classmethod
+    def pairwise_kl(cls, means, variances):
+        """
+        Calculates the matrix of KL divergences between many gaussians, given
+        as 1D arrays of their means and variances. Element [i,j] is the KL
+        divergence of gaussian i (LHS) from gaussian j (RHS).
+        """
+        means = np.asarray(means, dtype=np.float64)
+        variances = np.asarray(variances, dtype=np.float64)
+        if means.ndim != 1 or means.shape != variances.shape:
+            raise ValueError("{}.{} needs 1D means and variances of the " \
+                    "same shape. Given shapes: {} and {}".format(
+                        cls.__name__,
+                        cls.pairwise_kl.__name__,
+                        means.shape,
+                        variances.shape
+                        )
+                    )
+        if np.any(variances == 0):
+            raise ValueError("{} objects cannot have zero variance.".format(
+                        cls.__name__)
+                    )
+
+        delta = means[:,None] - means[None,:]
+        var_1 = variances[:,None]
+        var_2 = variances[None,:]
+        return 0.5 * (np.log(var_2/var_1) + (var_1 + delta*delta)/var_2 - 1.)
+
 def gaus_1D_from_json(json_string):
     '''Create a Gaus1D object from a json string'''
     try:
-        obj = json.loads(json_string)
+        obj = _json.loads(json_string)
         g = Gaus1D(0,1,2)
-        g.mean = float(obj['mean'])
-        g.variance = float(obj['variance'])
-        g.M2 = float(obj['M2'])
-        g.n = float(obj['n'])
+        # non-finite values are written as null; a product has no n or M2
+        g.mean = float('nan') if obj['mean'] is None else float(obj['mean'])
+        g.variance = float('nan') if obj['variance'] is None else float(obj['variance'])
+        g.M2 = None if obj['M2'] is None else float(obj['M2'])
+        g.n = None if obj['n'] is None else float(obj['n'])
         g.dist_type = str(obj["dist_type"])
     except:
         raise ValueError('{} did not map to class structure: {}'.format(json_string,Gaus1D(0,1,2).to_json_string()))
-    return g.copy()
+    return g
 
 if __name__ == '__main__':
     # Unit tests
@@ -126,8 +252,39 @@ if __name__ == '__main__':
     g1 = Gaus1D(2.0,2.0**2)
     g2 = Gaus1D(2.0,4.0**2)
 
-    print(g1.__dict__)
+    print(g1.to_json_string())
     print('g2',g2)
     mystr = g2.to_json_string()
     g1 = gaus_1D_from_json(mystr).update(3.0)
     print(g1)
+
+    # product_many matches chaining __mul__
+    means = [1.0, 3.0, -1.0]
+    variances = [2.0, 4.0, 0.5]
+    chained = Gaus1D(means[0],variances[0])
+    for m, v in zip(means[1:], variances[1:]):
+        chained = chained * Gaus1D(m,v)
+    fused = Gaus1D.product_many(means, variances)
+    assert math.isclose(fused.mean, chained.mean)
+    assert math.isclose(fused.variance, chained.variance)
+    print('product_many', fused)
+
+    # pairwise_kl[i,j] matches KL_Div of gaussian i from gaussian j
+    K = Gaus1D.pairwise_kl(means, variances)
+    for i in range(len(means)):
+        for j in range(len(means)):
+            KL = Gaus1D(means[i],variances[i]).KL_Div(Gaus1D(means[j],variances[j]))
+            assert math.isclose(K[i,j], KL, abs_tol=1e-12)
+    print('pairwise_kl', K)
+
+    # update_batch matches calling update on each point
+    points = [0.5, 2.0, -1.0, 3.5]
+    g_loop = Gaus1D(2.0,2.0**2)
+    for point in points:
+        g_loop.update(point)
+    g_batch = Gaus1D(2.0,2.0**2)
+    g_batch.update_batch(points)
+    assert g_batch.n == g_loop.n
+    assert math.isclose(g_batch.mean, g_loop.mean)
+    assert math.isclose(g_batch.variance, g_loop.variance)
+    print('update_batch', g_batch)
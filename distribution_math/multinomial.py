@@ -1,8 +1,17 @@
-import json
-import copy
 import math
 
+import numpy as np
+
+try:
+    from . import _json
+except ImportError:
+    # run as a script, e.g. python distribution_math/multinomial.py
+    import _json
+
 class Multinomial(object):
+    __slots__ = ('dist_type', '_n', '_p', '_logp', '_total_n', '_p_dirty',
+            'size', 'labeled', 'labels')
+
     def __init__(self, size=1, prior_strength=1.):
         """
         Set up a multinomial distribution with a discrete number of classes
@@ -31,17 +40,46 @@ class Multinomial(object):
                     'larger than 1'.format(self.dist_type))
 
         self.dist_type = self.__class__.__name__
-        self._n = {n : prior_strength for n in range(size)}
-        self._p = {n : 1./float(size) for n in range(size)}
+        self._n = np.full(size, prior_strength, dtype=np.float64)
+        self._p = np.full(size, 1./float(size), dtype=np.float64)
+        self._total_n = size * prior_strength
+        self._p_dirty = False  # _p is recomputed from _n on the next read
+        self._logp = None  # log(_p), computed on first use
         self.size = size
         self.labeled = False
         self.labels = {}  # you have exactly one chance to label data
 
     def __repr__(self):
-        return json.dumps(self.__dict__,indent=2)
+        return '{}(size={}, n_sum={:.3g})'.format(
+                self.dist_type, self.size, float(self._total_n))
+
+    def _to_dict(self):
+        """
+        Plain python representation of the object, with the class arrays
+        converted to lists so that it can be serialized. Undefined (nan)
+        counts are written as null by the encoder.
+        """
+        return {
+            'dist_type': self.dist_type,
+            '_n': self._n.tolist(),
+            '_p': self._probabilities().tolist(),
+            'size': self.size,
+            'labeled': self.labeled,
+            'labels': self.labels,
+        }
 
     def copy(self):
-        return copy.deepcopy(self)
+        m = self.__class__.__new__(self.__class__)
+        m.dist_type = self.dist_type
+        m._n = self._n.copy()
+        m._p = self._p.copy()
+        m._logp = None if self._logp is None else self._logp.copy()
+        m._total_n = self._total_n
+        m._p_dirty = self._p_dirty
+        m.size = self.size
+        m.labeled = self.labeled
+        m.labels = dict(self.labels)
+        return m
 
     def reset_labels(self):
         """
@@ -53,20 +91,22 @@ class Multinomial(object):
     def relabel(self,labels):
         """
         Takes a dictionary of labels {"label":element} such that classes can be called
-        with a unique label "label", to refer to an integer element.
+        with a unique label "label", to refer to an integer element. Labels
+        cannot be integers, so integer class indices keep working after
+        relabeling; any other unknown label raises KeyError.
         """
         if not isinstance(labels,dict):
             raise ValueError("Must use a dictionary of {'label':integer} to relabel classes of Multinomial" )
         if len(labels) != self.size:
             raise ValueError("Must have the same number of elements as labels in Multinomial. There are {} elements and {} labels.".format(self.size, len(labels)))
-        observed_values = {}
-        observed_labels = {}
-        for k,v in labels.items():
-            if not isinstance(v,int) or v not in range(self.size) or isinstance(k,int) or k in observed_labels or v in observed_values:
-                print (k, v)
-                raise ValueError("Labels must uniquely map to integer which is contained in Multinomial classes.")
-            observed_labels[k] = None
-            observed_values[v] = None
+        values = list(labels.values())
+        valid = (not any(isinstance(k,int) for k in labels)
+                and all(isinstance(v,int) for v in values)
+                and len(set(values)) == len(values))
+        if valid:
+            valid = min(values) >= 0 and max(values) < self.size
+        if not valid:
+            raise ValueError("Labels must uniquely map to integer which is contained in Multinomial classes.")
         self.labels = labels
         self.labeled = True
 
@@ -74,15 +114,21 @@ class Multinomial(object):
         """
         Filter a potential label into a lookup index
         """
+        if type(i) is int and not self.labeled and 0 <= i < self.size:
+            return i
         lookup_i = i
-        if self.labeled == True:
-            try:
-                lookup_i = self.labels[i]
-            except:
-                KeyError("No label {} exists for Multinomial".format(i))
-        if lookup_i not in range(self.size):
+        if self.labeled:
+            lookup_i = self.labels.get(i)
+            if lookup_i is None:
+                if not isinstance(i, (int, np.integer)):
+                    raise KeyError("No label {} exists for Multinomial".format(i))
+                lookup_i = i
+        elif isinstance(i, float) and i.is_integer():
+            lookup_i = int(i)
+        if not isinstance(lookup_i, (int, np.integer)) or not 0 <= lookup_i < self.size:
             raise ValueError("Multinomial lookup out of range. Asked for {}, maps to {}, but possible index range is [0:{})".format(i,lookup_i,self.size))
-        return lookup_i
+        # a plain int, so that e.g. True indexes class 1 and not a boolean mask
+        return int(lookup_i)
 
     def _set_p(self,i,p):
         """
@@ -90,7 +136,8 @@ class Multinomial(object):
         foot off.
         """
         index = self._label_to_index(i)
-        self._p[index] = p
+        self._probabilities()[index] = p
+        self._logp = None
 
     def _set_n(self,i,n):
         """
@@ -99,37 +146,85 @@ class Multinomial(object):
         checking, don't shoot your foot off.
         """
         index = self._label_to_index(i)
+        self._check_counts_defined()
+        self._total_n += n - self._n[index]
         self._n[index] = n
+        self._p_dirty = True
+
+    def _check_counts_defined(self):
+        """
+        Counts are undefined (nan) after a product, so they cannot be updated
+        until set_prior_strength gives them a scale again.
+        """
+        if math.isnan(self._total_n):
+            raise ValueError("{} counts are undefined after multiplication. " \
+                    "Call set_prior_strength() before updating.".format(
+                        self.dist_type))
 
     def get_max_p(self):
         """
         Returns the indicies of _p with the maximum probability. If several
         keys have the same value, then a list of those keys are returned.
         """
-        return [k for k,v in self._p.items() if v == max(self._p.values())]
+        p = self._probabilities()
+        max_p = p.max()
+        return np.flatnonzero(p == max_p).tolist()
 
     def get_max_n(self):
         """
-        Returns the indicies of _n with the maximum probability. If several
+        Returns the indicies of _n with the maximum count. If several
         keys have the same value, then a list of those keys are returned.
         """
-        return [k for k,v in self._n.items() if v == max(self._n.values())]
+        max_n = self._n.max()
+        return np.flatnonzero(self._n == max_n).tolist()
+
+    def _probabilities(self):
+        """
+        Returns the array of class probabilities, renormalizing the counts
+        first if they changed since the last read.
+        """
+        if self._p_dirty:
+            # re-sum so the running total cannot drift from the counts
+            self._total_n = float(self._n.sum())
+            self._p = self._n / self._total_n
+            self._p_dirty = False
+            self._logp = None
+        return self._p
+
+    def _log_probabilities(self):
+        """
+        Returns the array of log class probabilities, cached until the
+        probabilities change. Empty classes map to -inf.
+        """
+        p = self._probabilities()
+        if self._logp is None:
+            with np.errstate(divide='ignore'):
+                self._logp = np.log(p)
+        return self._logp
 
     def get_p(self,class_label):
         """
         Returns ith class probability
         """
         index = self._label_to_index(class_label)
-        return self._p[index]
+        p = self._probabilities() if self._p_dirty else self._p
+        return p.item(index)
 
     def get_n(self, class_label):
         """
         Returns nth class probability
         """
         index = self._label_to_index(class_label)
-        return self._n[index]
+        return self._n.item(index)
 
     def __mul__(self,b1):
+        return self.copy().__imul__(b1)
+
+    def __imul__(self,b1):
+        """
+        In place product, b *= likelihood. Reuses this object's probability
+        buffer, so sequential updates allocate nothing per step.
+        """
         if not isinstance(b1,Multinomial):
             raise ValueError("Must multiply two Multinomial type objects. " \
                     "Type of argument is: {}".format(type(b1)))
@@ -137,25 +232,19 @@ class Multinomial(object):
             raise ValueError("Multinomial multiplication must be done on " \
                     "distributions of the same dimension. The two dimensions "\
                     "were {} and {}".format(self.size,b1.size))
-        
-        b_new = self.copy()
-        for i in range(self.size):
-            b_new._p[i] = self.get_p(i)*b1.get_p(i)
-            b_new._set_n(i,None)
 
-        norm = 0.
-        for index,p in b_new._p.items():
-            norm += p
-
-        b_new._p = {index:p/norm for index,p in b_new._p.items() }
-        return b_new
+        p = self._probabilities()
+        np.multiply(p, b1._probabilities(), out=p)
+        p *= 1./p.sum()
+        self._logp = None
+        # counts are not defined for a product of distributions
+        self._n.fill(np.nan)
+        self._total_n = np.nan
+        return self
 
     def __rmul__(self,b1):
         return self.__mul__(b1)
 
-    def copy(self):
-        return copy.deepcopy(self)
-
     def update(self, class_label , weight=1):
         """
         class_label can be a name or an index
@@ -163,17 +252,15 @@ class Multinomial(object):
         We update the weight of the class by weight.
         """
         index = self._label_to_index(class_label)
-        try:
-            self._n[index] += weight
-        except:
-            print("Exception: Multinomial::update indexing error with self._n[index] += weight","self._n:",self._n,"index:",index)
+        self._check_counts_defined()
+        self._n[index] += weight
+        self._total_n += weight
 
-        # TODO: move probabilities to log space
-        total = sum([v for k,v in self._n.items()])
-        self._p = { k : (n / total) for k,n in self._n.items()}
+        # _p and _logp are recomputed on the next read
+        self._p_dirty = True
 
     def to_json_string(self):
-        return(json.dumps(self.__dict__))
+        return(_json.dumps(self._to_dict()))
 
     def KL_Div(self,m1):
         """
@@ -181,15 +268,14 @@ class Multinomial(object):
         distribution.
         """
         if not isinstance(m1,Multinomial):
-            raise ValueError("Must multiply two Multinomial type objects. Type of argument is: {}".format(type(b1)))
+            raise ValueError("Must multiply two Multinomial type objects. Type of argument is: {}".format(type(m1)))
         if self.size != m1.size:
             raise ValueError("Multinomial multiplication must be done on distributions of the same dimension. The two dimensions were {} and {}".format(self.size,m1.size))
-        KL = 0.
-        for i in range(self.size):
-            p = self.get_p(i)
-            q = m1.get_p(i)
-            KL += p * math.log(p/q)
-        return KL
+        p = self._probabilities()
+        # classes with zero probability contribute nothing to the sum
+        log_ratio = np.subtract(self._log_probabilities(),
+                m1._log_probabilities(), out=np.zeros(self.size), where=p > 0)
+        return float(np.dot(p, log_ratio))
 
     def set_prior_strength(self,prior_strength):
         """
@@ -198,7 +284,8 @@ class Multinomial(object):
         for each class.
         """
         assert prior_strength > 0, "{} scale value must be positive".format(self.dist_type)
-        self._n = {k:(prior_strength*self._p[k]) for k,v in self._n.items()}
+        self._n = prior_strength * self._probabilities()
+        self._total_n = float(self._n.sum())
 
     def get_cumulative_n(self):
         """
@@ -207,28 +294,41 @@ class Multinomial(object):
         been called, then this value represents exactly the number of data points
         that the distribution has been trained on.
         """
-        return sum([v for k,v in self._n.items()])
+        self._probabilities()  # refreshes _total_n if the counts changed
+        return float(self._total_n)
+
+def _array_from_json(values):
+    """
+    Class arrays are serialized as lists. Older serializations stored them as
+    {"index":value} dictionaries, which are still accepted.
+    """
+    if isinstance(values, dict):
+        values = [values[k] for k in sorted(values, key=int)]
+    return np.array(values, dtype=np.float64)
 
 def multinomial_from_json(json_str):
-    obj = json.loads(json_str)
+    obj = _json.loads(json_str)
     m = Multinomial(1,1)
-    m._n = {int(k):v for k,v in obj['_n'].items()} 
-    m._p = {int(k):v for k,v in obj['_p'].items()}
+    m._n = _array_from_json(obj['_n'])
+    m._p = _array_from_json(obj['_p'])
+    m._total_n = float(m._n.sum())
+    m._p_dirty = False
+    m._logp = None
     m.size = obj['size']
     m.labeled = obj['labeled']
     m.labels = obj['labels']
     m.dist_type = obj['dist_type']
-    return m.copy()
+    return m
 
 if __name__ == '__main__':
     b1 = Multinomial(2)
-    print("b1.__dict__",b1.__dict__)
+    print("b1",b1.to_json_string())
     labels = {'funny':0, 'dumbshit':1}
     b1.relabel(labels)
     print (b1.get_p('funny'))
     print (b1.get_n('dumbshit'))
     print(b1)
-    print("b1.__dict__",b1.__dict__)
+    print("b1",b1.to_json_string())
     b2 = Multinomial(3)
     print(b2)
     print(b2.get_p(2))
@@ -237,3 +337,50 @@ if __name__ == '__main__':
     print("b4:",b4)
     b4 = multinomial_from_json(b1.to_json_string())
     print("b4:",b4)
+
+    # in place product matches __mul__ and leaves the right operand alone
+    prior = Multinomial(3)
+    prior.update(0)
+    prior.update(0)
+    likelihood = Multinomial(3)
+    likelihood.update(1)
+    product = prior * likelihood
+    buffer = prior._probabilities()
+    prior *= likelihood
+    assert prior._p is buffer
+    assert np.allclose(prior._probabilities(), product._probabilities())
+    assert np.allclose(likelihood._probabilities(), [0.25, 0.5, 0.25])
+    assert multinomial_from_json(prior.to_json_string()).get_p(0) == prior.get_p(0)
+    print("prior *= likelihood:", prior.to_json_string())
+
+    # counts of a product are undefined until a prior strength is set
+    posterior = Multinomial(3) * Multinomial(3)
+    try:
+        posterior.update(0)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("update of a product should raise ValueError")
+    assert np.allclose(posterior._probabilities(), 1./3)
+    posterior.set_prior_strength(3)
+    posterior.update(0)
+    assert np.allclose(posterior._probabilities(), [0.5, 0.25, 0.25])
+    assert posterior.get_cumulative_n() == 4.
+
+    # classes with zero probability in p add nothing to the KL divergence,
+    # and p > 0 where q == 0 makes it infinite
+    sparse = Multinomial(3, prior_strength=0.)
+    sparse.update(0)
+    uniform = Multinomial(3)
+    assert math.isclose(sparse.KL_Div(uniform), math.log(3))
+    assert sparse.KL_Div(sparse) == 0.
+    assert uniform.KL_Div(sparse) == float('inf')
+
+    # relabel rejects labels that map to the same class or out of range
+    for bad_labels in [{'a':0, 'b':0, 'c':2}, {'a':0, 'b':1, 'c':2**70}]:
+        try:
+            Multinomial(3).relabel(bad_labels)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("relabel should reject {}".format(bad_labels))
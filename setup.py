@@ -8,6 +8,8 @@ setup(
       author_email='michael.beaumier@gmail.com',
       url='http://github.com/Jollyhrothgar/distribution_math',
       packages = ['distribution_math'],
+      install_requires = ['numpy'],
+      extras_require = {'fast': ['numba', 'orjson']},
       classifiers=[
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',